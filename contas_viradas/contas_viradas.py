@@ -1,11 +1,47 @@
+import re
 import streamlit as st
+import numpy as np
 import pandas as pd
+import xlsxwriter
+from concurrent.futures import Future, ThreadPoolExecutor
 from io import BytesIO
-from bs4 import BeautifulSoup
-
-def parse_balancete_html(html_content: str) -> pd.DataFrame:
+from lxml import etree
+
+# Regras de conta virada, compiladas uma única vez na importação do módulo:
+# (motivo, prefixo da Classificação, indicador D/C que caracteriza a virada).
+# Os prefixos são mutuamente exclusivos, então no máximo uma regra se aplica.
+REGRAS_VIRADA = (
+    ("Ativo (1) com saldo Credor (C)", re.compile(r"^1"), "C"),
+    ("Passivo (2) com saldo Devedor (D)", re.compile(r"^2"), "D"),
+    ("Bloco 3: Devedora", re.compile(r"^(3\.1\.1|3\.2\.2\.03|3\.2\.4|3\.2\.5)"), "D"),
+    ("Bloco 3: Credora", re.compile(r"^(3\.1\.2|3\.1\.7|3\.2\.2\.01|3\.2\.3)"), "C"),
+)
+
+# Colunas com poucos valores distintos são armazenadas como categorias.
+# A ordem das categorias define os códigos usados em marcar_contas_viradas.
+DC_DTYPE = pd.CategoricalDtype(["", "C", "D"])
+VIRADA_DTYPE = pd.CategoricalDtype(["Não", "Sim"])
+MOTIVO_DTYPE = pd.CategoricalDtype([""] + [motivo for motivo, _, _ in REGRAS_VIRADA])
+AVALIAR_DTYPE = pd.CategoricalDtype(["", "Avaliar no detalhe"])
+
+# Rótulos do cabeçalho do balancete e a coluna do DataFrame que recebe cada valor
+CABECALHO = (("Empresa", "Empresa"), ("CNPJ", "C.N.P.J."), ("Período", "Período"))
+# Célula <th> seguinte ao rótulo informado, em uma linha de cabeçalho
+# (o &nbsp; é tratado como espaço, assim como no strip() do Python)
+XPATH_VALOR_CABECALHO = etree.XPath(
+    "th[starts-with(normalize-space(translate(., '\u00a0', ' ')), $rotulo)]"
+    "/following-sibling::th[1]"
+)
+
+# Acima deste número de linhas a tabela completa é exibida sem destaque
+LIMITE_LINHAS_DESTAQUE = 5000
+
+@st.cache_data(show_spinner=False)
+def parse_balancete_html(html_bytes: bytes) -> pd.DataFrame:
     """
     Faz o parse do arquivo HTML do balancete, criando um DataFrame com as colunas relevantes.
+    Recebe o conteúdo bruto do arquivo; a codificação é detectada pelo lxml a partir
+    da tag <meta> (na ausência dela, é assumido latin-1).
 
     Retorna um DataFrame com:
       - Código
@@ -17,32 +53,31 @@ def parse_balancete_html(html_content: str) -> pd.DataFrame:
       - CNPJ
       - Período
     """
-    soup = BeautifulSoup(html_content, "html.parser")
-    rows = soup.find_all("tr")
-    
     # Extração dos dados do cabeçalho: Empresa, CNPJ e Período
-    empresa = None
-    cnpj = None
-    periodo = None
-
-    for row in rows:
-        ths = row.find_all("th")
-        for idx, th in enumerate(ths):
-            text = th.get_text(strip=True)
-            if text.startswith("Empresa"):
-                if len(ths) > idx + 1:
-                    empresa = ths[idx+1].get_text(strip=True)
-            elif text.startswith("C.N.P.J."):
-                if len(ths) > idx + 1:
-                    cnpj = ths[idx+1].get_text(strip=True)
-            elif text.startswith("Período"):
-                if len(ths) > idx + 1:
-                    periodo = ths[idx+1].get_text(strip=True)
-    
-    data_rows = []
-    for row in rows:
-        cols = row.find_all("td")
-        cols_text = [c.get_text(strip=True) for c in cols]
+    cabecalho = dict.fromkeys(coluna for coluna, _ in CABECALHO)
+
+    # Acumula os valores por coluna; o DataFrame é montado uma única vez no final
+    codigos = []
+    classificacoes = []
+    descricoes = []
+    saldos_atuais = []
+
+    # Percorre as linhas em um único passo, descartando cada <tr> já lido
+    context = etree.iterparse(BytesIO(html_bytes), html=True, tag="tr")
+    for _, row in context:
+        # Só linhas com <th> podem conter o cabeçalho
+        if row.find("th") is not None:
+            for coluna, rotulo in CABECALHO:
+                valores = XPATH_VALOR_CABECALHO(row, rotulo=rotulo)
+                if valores:
+                    cabecalho[coluna] = "".join(valores[-1].itertext()).strip()
+
+        # Células sem marcação interna (o caso comum) já trazem o texto em .text;
+        # itertext() só é necessário quando há tags dentro da célula
+        cols_text = [
+            ("".join(c.itertext()) if len(c) else (c.text or "")).strip()
+            for c in row.iterchildren("td")
+        ]
         # Checa se há colunas suficientes para ser uma linha de conta
         if len(cols_text) >= 10:
             codigo = cols_text[0].strip()
@@ -55,44 +90,55 @@ def parse_balancete_html(html_content: str) -> pd.DataFrame:
                     descricao = cols_text[i]
                     break
 
-            # Detecta saldo atual e seu indicador (D/C)
-            saldo_atual_valor = ""
-            saldo_atual_indicador = ""
+            # Detecta o saldo atual com seu indicador (ex.: "123.456,78D");
+            # a conversão para número é feita de forma vetorizada no final
+            saldo_atual = ""
             tail = cols_text[-5:]
             for item in reversed(tail):
                 item = item.strip()
                 if item.endswith("D") or item.endswith("C"):
-                    saldo_atual_valor = item[:-1].strip()
-                    saldo_atual_indicador = item[-1]  # 'D' ou 'C'
+                    saldo_atual = item
                     break
 
-            # Converter saldo em valor numérico
-            numeric_value = 0.0
-            if saldo_atual_valor:
-                clean_str = saldo_atual_valor.replace(".", "").replace(",", ".")
-                try:
-                    numeric_value = float(clean_str)
-                except:
-                    numeric_value = 0.0
-
             if codigo or descricao:
-                data_rows.append({
-                    "Código": codigo,
-                    "Classificação": classificacao,
-                    "Descrição": descricao if descricao else "",
-                    "Saldo Atual (Valor)": numeric_value,
-                    "Saldo Atual (D/C)": saldo_atual_indicador,
-                    "Empresa": empresa,
-                    "CNPJ": cnpj,
-                    "Período": periodo
-                })
-
-    df = pd.DataFrame(data_rows)
+                codigos.append(codigo)
+                classificacoes.append(classificacao)
+                descricoes.append(descricao if descricao else "")
+                saldos_atuais.append(saldo_atual)
+
+        # Libera a linha e as irmãs anteriores para manter a memória constante
+        row.clear()
+        while row.getprevious() is not None:
+            del row.getparent()[0]
+
+    # Separa o indicador (D/C) e converte o saldo em valor numérico
+    saldos = pd.Series(saldos_atuais, dtype=object)
+    saldos_dc = saldos.str[-1].fillna("").astype(DC_DTYPE)
+    saldos_valor = pd.to_numeric(
+        saldos.str[:-1].str.strip()
+        .str.replace(".", "", regex=False)
+        .str.replace(",", ".", regex=False),
+        errors="coerce"
+    ).fillna(0.0)
+
+    df = pd.DataFrame({
+        "Código": codigos,
+        "Classificação": classificacoes,
+        "Descrição": descricoes,
+        "Saldo Atual (Valor)": saldos_valor,
+        "Saldo Atual (D/C)": saldos_dc
+    })
+    # O cabeçalho pode aparecer em qualquer ponto do arquivo, então só é
+    # atribuído depois de percorrer todas as linhas. Cada coluna é uma categoria
+    # única: um código int8 por linha em vez de N referências à mesma string.
+    for coluna, valor in cabecalho.items():
+        df[coluna] = pd.Series(valor, index=df.index, dtype="category")
     # Preenche valores vazios em 'Descrição' com string vazia
     df['Descrição'] = df['Descrição'].fillna("")
     return df
 
 
+@st.cache_data(show_spinner=False)
 def marcar_contas_viradas(df: pd.DataFrame) -> pd.DataFrame:
     """
     Ajusta as colunas 'Virada', 'Motivo' e 'Avaliar' com base nas regras:
@@ -109,90 +155,65 @@ def marcar_contas_viradas(df: pd.DataFrame) -> pd.DataFrame:
 
     df = df.copy()
 
-    # Cria as colunas padrão
-    df['ViradaBool'] = False
-    df['Virada'] = "Não"
-    df['Motivo'] = ""
-    df['Avaliar'] = "Avaliar no detalhe"
+    classificacao = df['Classificação']
+    saldo_dc = df['Saldo Atual (D/C)']
+    descricao = df['Descrição']
 
-    # 1. Ativo + Credor
-    cond_ativo_c = (
-        df['Classificação'].str.startswith('1') &
-        (df['Saldo Atual (D/C)'] == 'C')
-    )
-    df.loc[cond_ativo_c, 'ViradaBool'] = True
-    df.loc[cond_ativo_c, 'Virada'] = "Sim"
-    df.loc[cond_ativo_c, 'Motivo'] = "Ativo (1) com saldo Credor (C)"
-    df.loc[cond_ativo_c, 'Avaliar'] = ""
-
-    # 2. Passivo + Devedor
-    cond_passivo_d = (
-        df['Classificação'].str.startswith('2') &
-        (df['Saldo Atual (D/C)'] == 'D')
-    )
-    df.loc[cond_passivo_d, 'ViradaBool'] = True
-    df.loc[cond_passivo_d, 'Virada'] = "Sim"
-    df.loc[cond_passivo_d, 'Motivo'] = "Passivo (2) com saldo Devedor (D)"
-    df.loc[cond_passivo_d, 'Avaliar'] = ""
-
-    # 3. Regras do bloco 3
-    #    - Contas que iniciem com 3.1.1, 3.2.2.03, 3.2.4, 3.2.5 => saldo 'D', descrição não inicia com "(-)"
-    #    - Contas que iniciem com 3.1.2, 3.1.7, 3.2.2.01, 3.2.3 => saldo 'C', descrição não inicia com "(-)"
-
-    cond_bloco3_dev = (
-        (
-            df['Classificação'].str.startswith('3.1.1') |
-            df['Classificação'].str.startswith('3.2.2.03') |
-            df['Classificação'].str.startswith('3.2.4') |
-            df['Classificação'].str.startswith('3.2.5')
-        ) &
-        (df['Saldo Atual (D/C)'] == 'D') &
-        ~df['Descrição'].str.startswith("(-)")
-    )
-    df.loc[cond_bloco3_dev, 'ViradaBool'] = True
-    df.loc[cond_bloco3_dev, 'Virada'] = "Sim"
-    df.loc[cond_bloco3_dev, 'Motivo'] = "Bloco 3: Devedora"
-    df.loc[cond_bloco3_dev, 'Avaliar'] = ""
-
-    cond_bloco3_cred = (
-        (
-            df['Classificação'].str.startswith('3.1.2') |
-            df['Classificação'].str.startswith('3.1.7') |
-            df['Classificação'].str.startswith('3.2.2.01') |
-            df['Classificação'].str.startswith('3.2.3')
-        ) &
-        (df['Saldo Atual (D/C)'] == 'C') &
-        ~df['Descrição'].str.startswith("(-)")
-    )
-    df.loc[cond_bloco3_cred, 'ViradaBool'] = True
-    df.loc[cond_bloco3_cred, 'Virada'] = "Sim"
-    df.loc[cond_bloco3_cred, 'Motivo'] = "Bloco 3: Credora"
-    df.loc[cond_bloco3_cred, 'Avaliar'] = ""
-
-    # 4. Se a conta foi marcada como virada, mas a descrição CONTÉM "(-)"
-    #    em qualquer posição, então "desvirar":
-    cond_reverter = (
-        (df['ViradaBool'] == True) &
-        df['Descrição'].str.contains(r"\(-\)", na=False)
-        # Regex \(-\) ou uma string literal "(-)" se preferir sem regex:
-        #  .contains("(-)", na=False) 
-    )
-    df.loc[cond_reverter, 'ViradaBool'] = False
-    df.loc[cond_reverter, 'Virada'] = "Não"
-    df.loc[cond_reverter, 'Motivo'] = ""
-    df.loc[cond_reverter, 'Avaliar'] = "Avaliar no detalhe"
+    # 4. Se a descrição CONTÉM "(-)" em qualquer posição, a conta nunca é
+    #    considerada virada ("desvirar"); vale como pré-condição de todas as regras
+    nao_redutora = ~descricao.str.contains("(-)", regex=False, na=False).to_numpy(dtype=bool)
+
+    # 1-3. Uma máscara por regra de REGRAS_VIRADA: prefixo da Classificação + indicador D/C
+    conds = [
+        (classificacao.str.match(prefixo) & (saldo_dc == dc)).to_numpy(dtype=bool) & nao_redutora
+        for _, prefixo, dc in REGRAS_VIRADA
+    ]
+
+    # Cada coluna de resultado é montada de uma só vez a partir do código da regra
+    # (0 = não virada, i = i-ésima regra, que é também a posição do motivo em MOTIVO_DTYPE)
+    codigo_regra = np.select(conds, range(1, len(conds) + 1), default=0).astype(np.int8)
+    virada = codigo_regra > 0
+
+    # Caso a conta não se encaixe em nenhuma regra, marca "Avaliar no detalhe"
+    df['ViradaBool'] = virada
+    df['Virada'] = pd.Categorical.from_codes(virada.astype(np.int8), dtype=VIRADA_DTYPE)
+    df['Motivo'] = pd.Categorical.from_codes(codigo_regra, dtype=MOTIVO_DTYPE)
+    df['Avaliar'] = pd.Categorical.from_codes((~virada).astype(np.int8), dtype=AVALIAR_DTYPE)
 
     return df
 
 
-def gerar_download_excel(df: pd.DataFrame, nome_arquivo: str) -> None:
+@st.cache_data(show_spinner=False)
+def gerar_excel_bytes(df: pd.DataFrame) -> bytes:
     """
-    Gera um botão de download para o DataFrame em formato XLSX dentro do Streamlit.
+    Serializa o DataFrame em XLSX. O resultado fica em cache enquanto o
+    DataFrame não mudar, evitando regerar o arquivo a cada rerun.
     """
     output = BytesIO()
-    with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-        df.to_excel(writer, index=False, sheet_name='Planilha')
-    data = output.getvalue()
+    # constant_memory descarta cada linha após gravá-la, mas exige escrita em
+    # ordem de linha; o to_excel do pandas grava por coluna, então as linhas
+    # são escritas diretamente
+    workbook = xlsxwriter.Workbook(output, {'constant_memory': True})
+    worksheet = workbook.add_worksheet('Planilha')
+    header_format = workbook.add_format(
+        {'bold': True, 'border': 1, 'align': 'center', 'valign': 'top'}
+    )
+    worksheet.write_row(0, 0, df.columns, header_format)
+    # Valores ausentes viram células vazias, como no to_excel
+    valores = df.astype(object).where(df.notna(), None)
+    for i, linha in enumerate(valores.itertuples(index=False, name=None), start=1):
+        worksheet.write_row(i, 0, linha)
+    workbook.close()
+    return output.getvalue()
+
+
+def gerar_download_excel(xlsx: Future, nome_arquivo: str) -> None:
+    """
+    Gera um botão de download para o XLSX gerado em segundo plano (Future de
+    gerar_excel_bytes) dentro do Streamlit, aguardando sua conclusão se necessário.
+    """
+    with st.spinner(f"Gerando {nome_arquivo}..."):
+        data = xlsx.result()
 
     st.download_button(
         label=f"Download: {nome_arquivo}",
@@ -202,24 +223,55 @@ def gerar_download_excel(df: pd.DataFrame, nome_arquivo: str) -> None:
     )
 
 
+@st.cache_data(show_spinner=False)
+def gerar_csv_bytes(df: pd.DataFrame) -> bytes:
+    """
+    Serializa o DataFrame em CSV no padrão brasileiro (separador ';' e
+    decimal ','). O BOM do utf-8-sig faz o Excel reconhecer os acentos.
+    """
+    return df.to_csv(index=False, sep=';', decimal=',').encode('utf-8-sig')
+
+
+def gerar_download_csv(df: pd.DataFrame, nome_arquivo: str) -> None:
+    """
+    Gera um botão de download para o DataFrame em formato CSV dentro do Streamlit.
+    """
+    st.download_button(
+        label=f"Download: {nome_arquivo}",
+        data=gerar_csv_bytes(df),
+        file_name=nome_arquivo,
+        mime="text/csv"
+    )
+
+
 def main():
     st.title("Verificador de Contas Viradas em Balancete")
 
     uploaded_file = st.file_uploader("Arraste o arquivo HTML do balancete aqui", type=["htm", "html"])
     
     if uploaded_file is not None:
-        html_content = uploaded_file.read().decode('latin-1', errors='replace')
+        # getvalue() não depende da posição do buffer, que persiste entre reruns
+        html_bytes = uploaded_file.getvalue()
         
         with st.spinner("Processando balancete..."):
-            df = parse_balancete_html(html_content)
+            df = parse_balancete_html(html_bytes)
             df = marcar_contas_viradas(df)
 
         if df.empty:
             st.warning("Não foi possível encontrar dados de contas no arquivo enviado.")
             return
 
-        df_viradas = df[df['ViradaBool'] == True]
-        total_viradas = df_viradas.shape[0]
+        # ViradaBool já é booleana: a mesma máscara filtra e conta
+        viradas = df['ViradaBool'].to_numpy()
+        total_viradas = int(np.count_nonzero(viradas))
+        df_viradas = df[viradas]
+
+        # Os XLSX são gerados em segundo plano enquanto as tabelas são exibidas;
+        # os botões de download aguardam o resultado no final da página
+        executor = ThreadPoolExecutor(max_workers=2)
+        xlsx_todas = executor.submit(gerar_excel_bytes, df)
+        xlsx_viradas = executor.submit(gerar_excel_bytes, df_viradas) if total_viradas > 0 else None
+        executor.shutdown(wait=False)
 
         if total_viradas > 0:
             st.error(f"Foram encontradas {total_viradas} contas viradas no balancete.")
@@ -230,11 +282,19 @@ def main():
 
         # Exibe tabela completa
         st.subheader("Tabela Completa de Contas")
-        styled_df = df.style.apply(
-            lambda row: ['background-color: #ffcccc' if row['ViradaBool'] else '' for _ in row],
-            axis=1
-        )
-        st.dataframe(styled_df)
+        if len(df) <= LIMITE_LINHAS_DESTAQUE:
+            # Estilo calculado uma única vez e aplicado igual a todas as colunas
+            destaque = np.where(viradas, 'background-color: #ffcccc', '')
+            styled_df = df.style.apply(lambda col: destaque, axis=0)
+            st.dataframe(styled_df)
+        else:
+            # O Styler gera o estilo de cada célula no servidor; em tabelas
+            # grandes a tabela completa é exibida sem destaque
+            st.caption(
+                f"Destaque das contas viradas desativado para balancetes com mais de "
+                f"{LIMITE_LINHAS_DESTAQUE} linhas. Consulte a tabela de contas viradas abaixo."
+            )
+            st.dataframe(df)
 
         # Exibe tabela somente das contas viradas
         st.subheader("Tabela de Contas Viradas")
@@ -245,9 +305,11 @@ def main():
 
         st.write("---")
         # Botões para exportar
-        gerar_download_excel(df, "todas_contas.xlsx")
+        gerar_download_csv(df, "todas_contas.csv")
+        gerar_download_excel(xlsx_todas, "todas_contas.xlsx")
         if not df_viradas.empty:
-            gerar_download_excel(df_viradas, "contas_viradas.xlsx")
+            gerar_download_csv(df_viradas, "contas_viradas.csv")
+            gerar_download_excel(xlsx_viradas, "contas_viradas.xlsx")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file